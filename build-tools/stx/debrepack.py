@@ -14,17 +14,28 @@
 
 # import apt
 import apt_pkg
+import concurrent.futures
+import copy
+import debian.changelog
 import debian.deb822
 from debian.debian_support import BaseVersion
 import discovery
 import git
 import hashlib
 import logging
+import mmap
 import os
 import progressbar
 import re
+import requests
+from requests.adapters import HTTPAdapter
 import shutil
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 import utils
 from utils import run_shell_cmd, get_download_url
 import yaml
@@ -35,6 +46,18 @@ DIST = os.environ.get('STX_DIST')
 CENGN_BASE = os.path.join(os.environ.get('CENGNURL'), "debian")
 CENGN_STRATEGY = os.environ.get('CENGN_STRATEGY')
 BTYPE = "@KERNEL_TYPE@"
+MMAP_THRESHOLD = 1 << 20
+# Tar balls written here are build intermediates, favour speed over ratio
+TAR_LEVEL = 1
+DOWNLOAD_RETRIES = 5
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+TAR_SUFFIXES = {'.tar.gz': 'gz', '.tgz': 'gz', '.tar.bz2': 'bz2', '.tar.xz': 'xz'}
+# Parsed meta_data.yaml files keyed by (path, mtime, size)
+META_DATA_CACHE = dict()
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+# The apt Sources indices are parsed once and shared by all packages
+APT_SOURCES = None
+APT_LOCK = threading.Lock()
 
 
 class DownloadProgress():
@@ -75,57 +98,164 @@ def checksum_dsc(dsc_file, logger):
     return True
 
 
-def get_str_md5(text):
+def get_str_sha256(text):
 
-    md5obj = hashlib.md5()
-    md5obj.update(text.encode())
-    _hash = md5obj.hexdigest()
-    return str(_hash)
+    return hashlib.sha256(text.encode()).hexdigest()
 
 
-def tar_cmd(tarball_name, logger):
+def fadvise(fd, advice):
+
+    try:
+        os.posix_fadvise(fd.fileno(), 0, 0, advice)
+    except (AttributeError, OSError):
+        pass
+
+
+def update_hash_from_file(hashobj, path, drop_cache=False):
+
+    # Hand large files to the hash as one mapped buffer, so the whole file
+    # is digested in a single C call without copying it into Python objects
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size < MMAP_THRESHOLD:
+            hashobj.update(fd.read())
+        else:
+            fadvise(fd, getattr(os, "POSIX_FADV_SEQUENTIAL", 0))
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hashobj.update(mm)
+            # Keep a one-off read of a big file from evicting hotter pages
+            if drop_cache:
+                fadvise(fd, getattr(os, "POSIX_FADV_DONTNEED", 0))
+
+
+def walk_files(top):
+
+    # Yield a DirEntry for every non-directory below top, the same set of
+    # files os.walk() reports (symlinks to directories are not followed)
+    with os.scandir(top) as it:
+        for entry in it:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    yield from walk_files(entry.path)
+            else:
+                yield entry
 
-    targz = re.match(r'.*.(tar\.gz|tar\.bz2|tar\.xz|tgz)$', tarball_name)
-    if targz is None:
-        logger.error('Not supported tarball type, the supported types are: tar.gz|tar.bz2|tar.xz|tgz')
-        raise ValueError(f'{tarball_name} type is not supported')
 
-    targz = targz.group(1)
-    # Refer to untar.py of debmake python module
-    if targz == 'tar.bz2':
-        cmd = 'tar --bzip2 -xf %s '
-        cmdx = 'tar --bzip2 -tf %s '
-        cmdc = 'tar --bzip2 -cf %s %s '
-    elif targz == 'tar.xz':
-        cmd = 'tar --xz -xf %s '
-        cmdx = 'tar --xz -tf %s '
-        cmdc = 'tar --xz -cf %s %s '
+def copy_path(src, dst, follow_symlinks=True):
+
+    # Equivalent of "cp -rL" (or "cp -r" with follow_symlinks=False)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src.rstrip(os.path.sep)))
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, symlinks=not follow_symlinks, dirs_exist_ok=True)
     else:
-        cmd = 'tar -xzf %s '
-        cmdx = 'tar -tzf %s '
-        cmdc = 'tar -czf %s %s '
+        shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
+
+
+def move_path(src, dst):
 
-    return cmd, cmdx, cmdc
+    # Move src over dst replacing whatever is in the way, like "tar xf"
+    # does, only real directories on both sides are merged
+    if os.path.isdir(src) and not os.path.islink(src) \
+            and os.path.isdir(dst) and not os.path.islink(dst):
+        for name in os.listdir(src):
+            move_path(os.path.join(src, name), os.path.join(dst, name))
+        shutil.copystat(src, dst)
+        return
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.unlink(dst)
+    os.rename(src, dst)
 
 
-def get_topdir(tarball_file, logger):
+def link_or_copy(src, dst):
+
+    # Only tar balls are hard linked: they are read-only inputs, while other
+    # files such as a .dsc may be rewritten in place by the Debian tools
+    if src.endswith(tuple(TAR_SUFFIXES)):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            # e.g. EXDEV when the mirror is on another filesystem
+            pass
+    return shutil.copy2(src, dst)
+
+
+def tar_compression(tarball_name, logger):
+
+    # Return the compression name used by the tarfile module
+    compression = next((v for k, v in TAR_SUFFIXES.items() if tarball_name.endswith(k)), None)
+    if compression is None:
+        logger.error('Not supported tarball type, the supported types are: tar.gz|tar.bz2|tar.xz|tgz')
+        raise ValueError(f'{tarball_name} type is not supported')
+
+    return compression
+
+
+def extract_tar(tarball_file, dest, logger):
 
     if not os.path.exists(tarball_file):
         logger.error('Not such file %s', tarball_file)
         raise IOError
+    compression = tar_compression(tarball_file, logger)
+
+    topdirs = set()
+    subdirs = set()
+
+    def record(members):
+        for member in members:
+            # Refuse to write outside dest, as "tar xf" does
+            for name in (member.name, member.linkname if member.islnk() else ''):
+                if name.startswith('/') or '..' in name.split('/'):
+                    logger.error('Unsafe member %s in %s', name, tarball_file)
+                    raise ValueError(f'{tarball_file}: member {name} is outside the destination')
+            parts = member.name.split('/', 2)
+            topdirs.add(parts[0])
+            if len(parts) > 1 and parts[1]:
+                subdirs.add(parts[1])
+            yield member
+
+    # Decompress the tar ball only once: unpack it next to dest while
+    # recording the member names, then decide whether a top directory
+    # has to be removed (like "tar --strip-components 1")
+    dest = os.path.abspath(dest)
+    # The "tar" filter keeps absolute symlinks and modes like "tar xf" but
+    # also rejects members landing outside dest, record() covers older Pythons
+    extract_args = {}
+    if hasattr(tarfile, 'data_filter'):
+        extract_args['filter'] = 'tar'
+    tmpdir = tempfile.mkdtemp(prefix=".untar_", dir=os.path.dirname(dest))
+    try:
+        with tarfile.open(tarball_file, 'r|%s' % compression) as tf:
+            tf.extractall(tmpdir, members=record(tf), **extract_args)
+
+        srcdir = tmpdir
+        # The tar ball has top directory
+        if len(topdirs) == 1 and subdirs:
+            srcdir = os.path.join(tmpdir, topdirs.pop())
 
-    tarball_name = os.path.basename(tarball_file)
-    _, cmdx, _ = tar_cmd(tarball_name, logger)
-    cmdx = cmdx + '| awk -F "/" \'{print $%s}\' | sort | uniq'
-    topdir = run_shell_cmd(cmdx % (tarball_file, "1"), logger)
-    subdir = run_shell_cmd(cmdx % (tarball_file, "2"), logger)
+        for name in os.listdir(srcdir):
+            move_path(os.path.join(srcdir, name), os.path.join(dest, name))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
-    # The tar ball has top directory
-    if len(topdir.split('\n')) == 1 and subdir != '':
-        return topdir.split('\n')[0]
-    # Return None if no top directory
+
+def create_tar(tarball_file, path, logger, arcname=None):
+
+    # Never fall back to tarfile's default gzip/bzip2 level 9, it is several
+    # times slower than the "gzip -6" that "tar czf" used to run
+    compression = tar_compression(tarball_file, logger)
+    if compression == 'xz':
+        level = {'preset': TAR_LEVEL}
     else:
-        return None
+        level = {'compresslevel': TAR_LEVEL}
+    # Replace rather than truncate, tarball_file may be hard linked to the
+    # local mirror
+    tmp_file = tarball_file + ".tmp"
+    with tarfile.open(tmp_file, 'w:%s' % compression, **level) as tf:
+        tf.add(path, arcname=arcname)
+    os.replace(tmp_file, tarball_file)
 
 
 def checksum(dl_file, checksum, cmd, logger):
@@ -133,22 +263,92 @@ def checksum(dl_file, checksum, cmd, logger):
     if not os.path.exists(dl_file):
         return False
 
-    check_sum = run_shell_cmd('%s %s |cut -d" " -f1' % (cmd, dl_file), logger)
-    if check_sum != checksum:
+    hashobj = hashlib.sha256() if cmd == "sha256sum" else hashlib.md5()
+    update_hash_from_file(hashobj, dl_file, drop_cache=True)
+    if hashobj.hexdigest() != checksum:
         logger.debug(f"{cmd} checksum mismatch of {dl_file}")
         return False
     return True
 
 
-def download(url, savepath, logger):
+def create_session():
+
+    # Keep-alive connections are reused for all files fetched from a host.
+    # The adapter does not retry, download() is the only retry layer.
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+    session = requests.Session()
+    # The body is copied raw from the socket, so ask for it unencoded like
+    # curl does, a gzip Content-Encoding would break the checksum
+    session.headers['Accept-Encoding'] = 'identity'
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download(url, savepath, logger, session):
     logger.info(f"Download {url} to {savepath}")
 
-    # Need to avoid using the shell as the URL may include '&' characters.
-    run_shell_cmd(["curl", "--fail", "--location", "--connect-timeout", "15",
-        "--speed-time", "15", "--speed-limit", "1", "--retry", "5",
-        "-o", savepath, url], logger)
+    # Transient failures restart the whole transfer, like curl's "--retry 5".
+    # The read timeout stands in for curl's "--speed-time 15 --speed-limit 1"
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+        try:
+            with session.get(url, stream=True, timeout=(15, 15)) as r:
+                if r.status_code in RETRY_STATUS and attempt < DOWNLOAD_RETRIES:
+                    logger.warning(f"Download {url} failed (HTTP {r.status_code}), retrying")
+                    continue
+                r.raise_for_status()
+                with open(savepath, 'wb') as f:
+                    shutil.copyfileobj(r.raw, f, 1 << 20)
+            return True
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                ReadTimeoutError, ProtocolError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logger.warning(f"Download {url} failed ({e}), retrying")
+
 
-    return True
+def read_series(series):
+
+    with open(series) as f:
+        for line in f:
+            patch_file = line.strip()
+            # Skip comment lines and blank lines
+            if patch_file.startswith('#') or patch_file == "":
+                continue
+            yield patch_file
+
+
+def apply_patch(patch, logger):
+
+    # No shell is needed to feed the patch to patch(1)
+    run_shell_cmd(['patch', '-p1', '-i', patch], logger)
+
+
+def load_meta_data(meta_data):
+
+    st = os.stat(meta_data)
+    key = (meta_data, st.st_mtime_ns, st.st_size)
+    if key not in META_DATA_CACHE:
+        with open(meta_data) as f:
+            META_DATA_CACHE[key] = yaml.load(f, Loader=YAML_LOADER)
+
+    # setup() rewrites some of the entries, never hand out the cached copy
+    return copy.deepcopy(META_DATA_CACHE[key])
+
+
+def get_apt_sources():
+
+    # Must be called with APT_LOCK held
+    global APT_SOURCES
+    if APT_SOURCES is None:
+        apt_pkg.init()
+        APT_SOURCES = apt_pkg.SourceRecords()
+    else:
+        APT_SOURCES.restart()
+    return APT_SOURCES
 
 
 def is_git_repo(path):
@@ -159,6 +359,18 @@ def is_git_repo(path):
         return False
 
 
+def git_rev_count(gitcmd, base_srcrev=None):
+
+    if base_srcrev is None:
+        return int(gitcmd.rev_list("--count", "HEAD", "--", "."))
+    return int(gitcmd.rev_list("--count", "%s..HEAD" % base_srcrev, "--", "."))
+
+
+def git_status_count(gitcmd):
+
+    return len(gitcmd.status("--porcelain", "--", ".").splitlines())
+
+
 class Parser():
 
     def __init__(self, basedir, output, log_level='info', srcrepo=None, btype="std"):
@@ -185,10 +397,16 @@ class Parser():
 
         self.srcrepo = srcrepo
         self.btype = btype
+        self.session = create_session()
         self.meta_data = dict()
         self.versions = dict()
         self.pkginfo = dict()
 
+    def close(self):
+
+        # Release the keep-alive connections held by the download session
+        self.session.close()
+
     def setup(self, pkgpath):
 
         if not os.path.isdir(pkgpath):
@@ -208,8 +426,7 @@ class Parser():
         if not os.path.exists(meta_data):
             self.logger.error("Not find meta_data.yaml")
             raise Exception("Not find meta_data.yaml")
-        with open(meta_data) as f:
-            self.meta_data = yaml.full_load(f)
+        self.meta_data = load_meta_data(meta_data)
 
         if "debver" not in self.meta_data:
             self.logger.error("No debver defined in meta_data.yaml")
@@ -243,9 +460,10 @@ class Parser():
                 self.meta_data['src_files'].append(src_path)
 
         self.versions["full_version"] = str(self.meta_data["debver"])
-        self.versions["upstream_version"] = BaseVersion(self.versions["full_version"]).upstream_version
-        self.versions["debian_revision"] = BaseVersion(self.versions["full_version"]).debian_revision
-        self.versions["epoch"] = BaseVersion(self.versions["full_version"]).epoch
+        base_version = BaseVersion(self.versions["full_version"])
+        self.versions["upstream_version"] = base_version.upstream_version
+        self.versions["debian_revision"] = base_version.debian_revision
+        self.versions["epoch"] = base_version.epoch
 
         self.logger.info("=== Package Name: %s", self.pkginfo["pkgname"])
         self.logger.info("=== Debian Package Name: %s", self.pkginfo["debname"])
@@ -258,7 +476,7 @@ class Parser():
     def set_build_type(self):
 
         local_debian = os.path.join(self.pkginfo["packdir"], "local_debian")
-        run_shell_cmd('cp -r %s %s' % (self.pkginfo["debfolder"], local_debian), self.logger)
+        copy_path(self.pkginfo["debfolder"], local_debian, follow_symlinks=False)
 
         # clean @KERNEL_TYPE@ if build type is std
         if self.btype == "std":
@@ -266,10 +484,20 @@ class Parser():
         else:
             btype = "-" + self.btype
 
-        sed_cmd = 'sed -i s#%s#%s#g %s'
-        for root, _, files in os.walk(local_debian):
-            for name in files:
-                run_shell_cmd(sed_cmd % (BTYPE, btype, os.path.join(root, name)), self.logger)
+        token = BTYPE.encode()
+        for entry in walk_files(local_debian):
+            try:
+                with open(entry.path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            if token not in data:
+                continue
+            # Like "sed -i", replace a symlink rather than write through it
+            if entry.is_symlink():
+                os.remove(entry.path)
+            with open(entry.path, 'wb') as f:
+                f.write(data.replace(token, btype.encode()))
 
         self.pkginfo["debfolder"] = os.path.join(local_debian)
 
@@ -288,16 +516,10 @@ class Parser():
             if revision_data["dist"] is not None:
                 dist = os.path.expandvars(revision_data["dist"])
 
-        git_rev_list = "cd %s;git rev-list --count HEAD ."
-        git_rev_list_from = "cd %s;git rev-list --count %s..HEAD ."
-        git_status = "cd %s;git status --porcelain . | wc -l"
-
         if "PKG_GITREVCOUNT" in revision_data:
-            if "PKG_BASE_SRCREV" in revision_data:
-                revision += int(run_shell_cmd(git_rev_list_from % (self.pkginfo["debfolder"], revision_data["PKG_BASE_SRCREV"]), self.logger))
-            else:
-                revision += int(run_shell_cmd(git_rev_list % self.pkginfo["debfolder"], self.logger))
-            revision += int(run_shell_cmd(git_status % self.pkginfo["debfolder"], self.logger))
+            gitcmd = git.Git(self.pkginfo["debfolder"])
+            revision += git_rev_count(gitcmd, revision_data.get("PKG_BASE_SRCREV"))
+            revision += git_status_count(gitcmd)
 
         if "SRC_GITREVCOUNT" in revision_data:
             if "src_path" not in self.meta_data:
@@ -305,11 +527,9 @@ class Parser():
                 raise Exception(f"SRC_GITREVCOUNT is set, but no \"src_path\" in meta_data.yaml")
             src_path = self.meta_data["src_path"]
             src_gitrevcount = revision_data["SRC_GITREVCOUNT"]
-            if "SRC_BASE_SRCREV" in src_gitrevcount:
-                revision += int(run_shell_cmd(git_rev_list_from % (src_path, src_gitrevcount["SRC_BASE_SRCREV"]), self.logger))
-            else:
-                revision += int(run_shell_cmd(git_rev_list % src_path, self.logger))
-            revision += int(run_shell_cmd(git_status % src_path, self.logger))
+            gitcmd = git.Git(src_path)
+            revision += git_rev_count(gitcmd, src_gitrevcount.get("SRC_BASE_SRCREV"))
+            revision += git_status_count(gitcmd)
 
         if "GITREVCOUNT" in revision_data:
             gitrevcount = revision_data["GITREVCOUNT"]
@@ -320,8 +540,9 @@ class Parser():
                 self.logger.error("Not set BASE_SRCREV in GITREVCOUNT")
                 raise Exception(f"Not set BASE_SRCREV in GITREVCOUNT")
             src_dir = os.path.expandvars(gitrevcount["SRC_DIR"])
-            revision += int(run_shell_cmd(git_rev_list_from % (src_dir, gitrevcount["BASE_SRCREV"]), self.logger))
-            revision += int(run_shell_cmd(git_status % src_dir, self.logger))
+            gitcmd = git.Git(src_dir)
+            revision += git_rev_count(gitcmd, gitrevcount["BASE_SRCREV"])
+            revision += git_status_count(gitcmd)
 
         if "stx_patch" in revision_data:
             if type(revision_data['stx_patch']) is not int:
@@ -343,34 +564,30 @@ class Parser():
             self.logger.error("%s: no such directory", debfolder)
             raise Exception(f"{debfolder}: no such directory")
 
-        files_list = list()
-        content = ""
-        for root, _, files in os.walk(debfolder):
-            for name in files:
-                files_list.append(os.path.abspath(os.path.join(root, name)))
+        # Resolve the top level paths so that src_files overlapping src_path
+        # (or the debian folder) end up in the set only once
+        files_set = set()
+        for entry in walk_files(os.path.realpath(debfolder)):
+            files_set.add(entry.path)
 
         if "src_path" in self.meta_data and self.meta_data["src_path"] is not None:
-            for root, _, files in os.walk(self.meta_data["src_path"]):
+            for entry in walk_files(os.path.realpath(self.meta_data["src_path"])):
                 # Ignore .git files in the checksum calculation
-                filenames = filter(lambda f: not f.startswith('.git'), files)
-                for name in filenames:
-                    files_list.append(os.path.join(root, name))
+                if not entry.name.startswith('.git'):
+                    files_set.add(entry.path)
 
         if "src_files" in self.meta_data:
             for src_file in self.meta_data['src_files']:
+                src_file = os.path.realpath(src_file)
                 if os.path.isdir(src_file):
-                    for root, _, files in os.walk(src_file):
-                        for name in files:
-                            files_list.append(os.path.join(root, name))
+                    for entry in walk_files(src_file):
+                        files_set.add(entry.path)
                 else:
-                    files_list.append(src_file)
-
-        for f in sorted(files_list):
-            with open(f, 'r', encoding="ISO-8859-1") as fd:
-                content += fd.read()
+                    files_set.add(src_file)
 
+        files_hash = self.checksum_files(pkgpath, sorted(files_set))
         if "revision" not in self.meta_data:
-            return get_str_md5(content)
+            return files_hash
 
         revision_data = self.meta_data["revision"]
         if "GITREVCOUNT" in revision_data:
@@ -378,14 +595,48 @@ class Parser():
             if "SRC_DIR" in gitrevcount:
                 src_dir = os.path.expandvars(gitrevcount["SRC_DIR"])
                 if os.path.exists(src_dir):
-                    content += run_shell_cmd("cd %s; git log --oneline -10" % src_dir, self.logger)
-                    content += run_shell_cmd("cd %s; git diff" % src_dir, self.logger)
-
-        return get_str_md5(content)
+                    git_log = run_shell_cmd(["git", "log", "--oneline", "-10"], self.logger, cwd=src_dir)
+                    git_diff = run_shell_cmd(["git", "diff"], self.logger, cwd=src_dir)
+                    return get_str_sha256(files_hash + git_log + git_diff)
+
+        return files_hash
+
+    def checksum_files(self, pkgpath, files_list):
+
+        # The cached hash is reused as long as no file changes its path,
+        # mtime or size. An edit that keeps both mtime and size (cp -p,
+        # rsync -t, touch -r) is not detected.
+        keyobj = hashlib.sha256()
+        for f in files_list:
+            st = os.stat(f)
+            keyobj.update(("%s %d %d\n" % (f, st.st_mtime_ns, st.st_size)).encode())
+        stat_key = keyobj.hexdigest()
+
+        # One cache file per package, overwritten whenever the key changes
+        cache_dir = os.path.join(self.output, ".checksum_cache")
+        cache_file = os.path.join(cache_dir, get_str_sha256(os.path.abspath(pkgpath)))
+        if os.path.isfile(cache_file):
+            with open(cache_file) as f:
+                cached = f.read().split()
+            if len(cached) == 2 and cached[0] == stat_key:
+                return cached[1]
+
+        sha256obj = hashlib.sha256()
+        for f in files_list:
+            update_hash_from_file(sha256obj, f)
+        files_hash = sha256obj.hexdigest()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = "%s.%d" % (cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write("%s %s\n" % (stat_key, files_hash))
+        os.replace(tmp_file, cache_file)
+
+        return files_hash
 
     def set_deb_format(self):
 
-        deb_format = run_shell_cmd('dpkg-source --print-format %s' % self.pkginfo["srcdir"], self.logger)
+        deb_format = run_shell_cmd(['dpkg-source', '--print-format', self.pkginfo["srcdir"]], self.logger)
         if re.match("1.0", deb_format):
             return "1.0", None
 
@@ -406,7 +657,9 @@ class Parser():
             os.mkdir(deb_folder)
 
         self.logger.info("Overwrite the debian folder by %s", metadata)
-        run_shell_cmd('cp -r %s/* %s' % (metadata, deb_folder), self.logger)
+        for name in os.listdir(metadata):
+            if not name.startswith('.'):
+                copy_path(os.path.join(metadata, name), deb_folder, follow_symlinks=False)
 
         series = os.path.join(metadata, "patches/series")
         if not os.path.isfile(series):
@@ -416,21 +669,13 @@ class Parser():
         if format_type == "quilt" and format_ver == "3.0":
             return True
 
-        f = open(series)
-        patches = f.readlines()
         patches_src = os.path.dirname(series)
-        f.close()
 
         pwd = os.getcwd()
         os.chdir(self.pkginfo["srcdir"])
-        for patch in patches:
-            patch_file = patch.strip()
-            # Skip comment lines and blank lines
-            if patch_file.startswith('#') or patch_file == "":
-                continue
+        for patch_file in read_series(series):
             self.logger.info("Apply src patch: %s", patch_file)
-            patch = os.path.join(patches_src, patch_file)
-            run_shell_cmd('patch -p1 < %s' % patch, self.logger)
+            apply_patch(os.path.join(patches_src, patch_file), self.logger)
         os.chdir(pwd)
 
         return True
@@ -439,8 +684,7 @@ class Parser():
 
         if "src_files" in self.meta_data:
             for src_file in self.meta_data['src_files']:
-                run_shell_cmd('cp -rL %s %s' % (src_file, self.pkginfo["srcdir"]),
-                              self.logger)
+                copy_path(src_file, self.pkginfo["srcdir"])
 
         if "dl_files" in self.meta_data:
             pwd = os.getcwd()
@@ -452,20 +696,11 @@ class Parser():
                     self.logger.error("No such file %s in local mirror", dl_file)
                     raise IOError
                 if dir_name is not None:
-                    cmd, _, cmdc = tar_cmd(dl_path, self.logger)
-                    # The tar ball has top directory
-                    if get_topdir(dl_path, self.logger) is not None:
-                        # Remove the top diretory
-                        cmd += '--strip-components 1 -C %s'
-                    # The tar ball is extracted under $PWD by default
-                    else:
-                        cmd += '-C %s'
-                    run_shell_cmd("mkdir -p %s" % dir_name, self.logger)
-                    run_shell_cmd(cmd % (dl_path, dir_name), self.logger)
-                    run_shell_cmd(cmdc % (dl_path, dir_name), self.logger)
-
-                run_shell_cmd('cp -rL %s %s' % (dl_path, self.pkginfo["srcdir"]),
-                              self.logger)
+                    os.makedirs(dir_name, exist_ok=True)
+                    extract_tar(dl_path, dir_name, self.logger)
+                    create_tar(dl_path, dir_name, self.logger)
+
+                copy_path(dl_path, self.pkginfo["srcdir"])
             os.chdir(pwd)
 
         files = os.path.join(self.pkginfo["debfolder"], "files")
@@ -474,8 +709,7 @@ class Parser():
 
         for root, _, files in os.walk(files):
             for name in files:
-                os.path.join(root, name)
-                run_shell_cmd('cp -rL %s %s' % (os.path.join(root, name), self.pkginfo["srcdir"]), self.logger)
+                copy_path(os.path.join(root, name), self.pkginfo["srcdir"])
 
         return True
 
@@ -486,40 +720,36 @@ class Parser():
         if not os.path.isfile(series):
             return True
 
-        f = open(series)
-        patches = f.readlines()
         patches_src = os.path.dirname(series)
-        f.close()
 
         patches_folder = os.path.join(self.pkginfo["srcdir"], "debian/patches")
         series_file = os.path.join(self.pkginfo["srcdir"], "debian/patches/series")
         if not os.path.isdir(patches_folder):
             os.mkdir(patches_folder)
-            os.mknod(series_file)
+            open(series_file, 'a').close()
 
+        quilt_patches = list()
         pwd = os.getcwd()
         os.chdir(self.pkginfo["srcdir"])
-        for patch in patches:
-            patch_file = patch.strip()
-            # Skip comment lines and blank lines
-            if patch_file.startswith('#') or patch_file == "":
-                continue
+        for patch_file in read_series(series):
             self.logger.info("Apply src patch: %s", patch_file)
             patch = os.path.join(patches_src, patch_file)
             if format_ver == "1.0":
-                run_shell_cmd('patch -p1 < %s' % patch, self.logger)
+                apply_patch(patch, self.logger)
             else:
                 if format_type == "quilt":
-                    run_shell_cmd('cp -r %s %s' % (patch, patches_folder), self.logger)
-                    with open(series_file, 'a') as f:
-                        f.write(patch_file + "\n")
-                    f.close()
+                    shutil.copy2(patch, patches_folder)
+                    quilt_patches.append(patch_file + "\n")
                 elif format_type == "native":
-                    run_shell_cmd('patch -p1 < %s' % patch, self.logger)
+                    apply_patch(patch, self.logger)
                 else:
                     self.logger.error('Invalid deb format: %s %s', format_ver, format_type)
                     raise Exception(f'[ Invalid deb format: {format_ver} {format_type} ]')
 
+        if quilt_patches:
+            with open(series_file, 'a') as f:
+                f.writelines(quilt_patches)
+
         os.chdir(pwd)
         return True
 
@@ -528,20 +758,13 @@ class Parser():
         series = os.path.join(self.pkginfo["debfolder"], "deb_patches/series")
         if not os.path.isfile(series):
             return True
-        f = open(series)
-        patches = f.readlines()
         patches_src = os.path.dirname(series)
 
         pwd = os.getcwd()
         os.chdir(self.pkginfo["srcdir"])
-        for patch in patches:
-            patch_file = patch.strip()
-            # Skip comment lines and blank lines
-            if patch_file.startswith('#') or patch_file == "":
-                continue
+        for patch_file in read_series(series):
             self.logger.info("Apply deb patch: %s", patch_file)
-            patch = os.path.join(patches_src, patch_file)
-            run_shell_cmd("patch -p1 < %s" % patch, self.logger)
+            apply_patch(os.path.join(patches_src, patch_file), self.logger)
         os.chdir(pwd)
 
         return True
@@ -551,17 +774,8 @@ class Parser():
         tarball_name = self.meta_data["dl_path"]["name"]
         tarball_file = os.path.join(self.pkginfo["packdir"], tarball_name)
 
-        cmd, _, _ = tar_cmd(tarball_name, self.logger)
-        # The tar ball has top directory
-        if get_topdir(tarball_file, self.logger) is not None:
-            # Remove the top diretory
-            cmd += '--strip-components 1 -C %s'
-        # The tar ball is extracted under $PWD by default
-        else:
-            cmd += '-C %s'
-
         os.mkdir(self.pkginfo["srcdir"])
-        run_shell_cmd(cmd % (tarball_file, self.pkginfo["srcdir"]), self.logger)
+        extract_tar(tarball_file, self.pkginfo["srcdir"], self.logger)
         self.copy_custom_files()
         self.create_orig_tarball()
         self.update_deb_folder()
@@ -576,8 +790,7 @@ class Parser():
         ver = self.versions["full_version"].split(":")[-1]
         dsc_file = os.path.join(self.pkginfo["packdir"], self.pkginfo["debname"] + "_" + ver + ".dsc")
 
-        cmd = "repo_manage.py upload_pkg -p %s  -r %s"
-        run_shell_cmd(cmd % (dsc_file, self.srcrepo), self.logger)
+        run_shell_cmd(["repo_manage.py", "upload_pkg", "-p", dsc_file, "-r", self.srcrepo], self.logger)
 
         return True
 
@@ -591,14 +804,15 @@ class Parser():
             debian_folder = os.path.join(self.pkginfo["srcdir"], "debian")
             if os.path.exists(debian_folder):
                 self.logger.info("Generate orig tarballs from git repositry %s", self.pkginfo["srcdir"])
-                run_shell_cmd('cd %s; gbp export-orig --upstream-tree=HEAD' % self.pkginfo["srcdir"], self.logger)
+                run_shell_cmd(['gbp', 'export-orig', '--upstream-tree=HEAD'], self.logger, cwd=self.pkginfo["srcdir"])
                 return
             # remove .git directory
-            run_shell_cmd('rm -rf %s' % os.path.join(self.pkginfo["srcdir"], ".git"), self.logger)
+            shutil.rmtree(os.path.join(self.pkginfo["srcdir"], ".git"), ignore_errors=True)
 
         srcname = os.path.basename(self.pkginfo["srcdir"])
         origtargz = self.pkginfo["debname"] + '_' + self.versions["upstream_version"] + '.orig.tar.gz'
-        run_shell_cmd('cd %s; tar czf %s %s' % (self.pkginfo["packdir"], origtargz, srcname), self.logger)
+        origtargz = os.path.join(self.pkginfo["packdir"], origtargz)
+        create_tar(origtargz, self.pkginfo["srcdir"], self.logger, arcname=srcname)
 
     def create_src_package(self):
 
@@ -607,7 +821,7 @@ class Parser():
             os.mkdir(self.pkginfo["srcdir"])
         else:
             # cp the .git folder, the git meta files in .git are symbol link, so need -L
-            run_shell_cmd('cp -rL %s %s' % (src_path, self.pkginfo["srcdir"]), self.logger)
+            copy_path(src_path, self.pkginfo["srcdir"])
 
         self.copy_custom_files()
         self.create_orig_tarball()
@@ -623,14 +837,14 @@ class Parser():
         if not os.path.exists(dl_hook):
             self.logger.error("%s doesn't exist", dl_hook)
             raise ValueError(f"{dl_hook} doesn't exist")
-        run_shell_cmd('cp -r %s %s' % (dl_hook, self.pkginfo["packdir"]), self.logger)
+        copy_path(dl_hook, self.pkginfo["packdir"], follow_symlinks=False)
 
         pwd = os.getcwd()
         os.chdir(self.pkginfo["packdir"])
         if not os.access("dl_hook", os.X_OK):
             self.logger.error("dl_hook can't execute")
             raise ValueError("dl_hook can't execute")
-        run_shell_cmd('./dl_hook %s' % os.path.basename(self.pkginfo["srcdir"]), self.logger)
+        run_shell_cmd(['./dl_hook', os.path.basename(self.pkginfo["srcdir"])], self.logger)
         origtar = self.pkginfo["pkgname"] + '_' + self.versions["upstream_version"]
         origtargz = origtar + '.orig.tar.gz'
         origtarxz = origtar + '.orig.tar.xz'
@@ -640,6 +854,30 @@ class Parser():
         self.update_deb_folder()
         self.apply_deb_patches()
 
+    def fetch_dl_file(self, dl_file, dl_file_info):
+
+        url = dl_file_info['url']
+        if "sha256sum" in dl_file_info:
+            check_cmd = "sha256sum"
+            check_sum = dl_file_info['sha256sum']
+        else:
+            self.logger.warning(f"{dl_file} missing sha256sum")
+            check_cmd = "md5sum"
+            check_sum = dl_file_info['md5sum']
+        if checksum(dl_file, check_sum, check_cmd, self.logger):
+            return
+
+        (dl_url, alt_dl_url) = get_download_url(url, self.strategy)
+        if alt_dl_url:
+            try:
+                download(dl_url, dl_file, self.logger, self.session)
+            except:
+                download(alt_dl_url, dl_file, self.logger, self.session)
+        else:
+            download(dl_url, dl_file, self.logger, self.session)
+        if not checksum(dl_file, check_sum, check_cmd, self.logger):
+            raise Exception(f'Failed to download {dl_file}')
+
     def download(self, pkgpath, mirror):
 
         self.setup(pkgpath)
@@ -654,50 +892,15 @@ class Parser():
         pwd = os.getcwd()
         os.chdir(saveto)
         if "dl_files" in self.meta_data:
-            for dl_file in self.meta_data['dl_files']:
-                dl_file_info = self.meta_data['dl_files'][dl_file]
-                url = dl_file_info['url']
-                if "sha256sum" in dl_file_info:
-                    check_cmd = "sha256sum"
-                    check_sum = dl_file_info['sha256sum']
-                else:
-                    self.logger.warning(f"{dl_file} missing sha256sum")
-                    check_cmd = "md5sum"
-                    check_sum = dl_file_info['md5sum']
-                if not checksum(dl_file, check_sum, check_cmd, self.logger):
-                    (dl_url, alt_dl_url) = get_download_url(url, self.strategy)
-                    if alt_dl_url:
-                        try:
-                            download(dl_url, dl_file, self.logger)
-                        except:
-                            download(alt_dl_url, dl_file, self.logger)
-
-                    else:
-                        download(dl_url, dl_file, self.logger)
-                    if not checksum(dl_file, check_sum, check_cmd, self.logger):
-                        raise Exception(f'Fail to download {dl_file}')
+            # The files are independent of each other, fetch them concurrently
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(self.fetch_dl_file, dl_file, dl_file_info)
+                           for dl_file, dl_file_info in self.meta_data['dl_files'].items()]
+                for future in futures:
+                    future.result()
 
         if "dl_path" in self.meta_data:
-            dl_file = self.meta_data["dl_path"]["name"]
-            url = self.meta_data["dl_path"]["url"]
-            if "sha256sum" in self.meta_data["dl_path"]:
-                check_cmd = "sha256sum"
-                check_sum = self.meta_data["dl_path"]['sha256sum']
-            else:
-                self.logger.warning(f"{dl_file} missing sha256sum")
-                check_cmd = "md5sum"
-                check_sum = self.meta_data["dl_path"]['md5sum']
-            if not checksum(dl_file, check_sum, check_cmd, self.logger):
-                (dl_url, alt_dl_url) = get_download_url(url, self.strategy)
-                if alt_dl_url:
-                    try:
-                        download(dl_url, dl_file, self.logger)
-                    except:
-                        download(alt_dl_url, dl_file, self.logger)
-                else:
-                    download(dl_url, dl_file, self.logger)
-                if not checksum(dl_file, check_sum, check_cmd, self.logger):
-                    raise Exception(f'Failed to download {dl_file}')
+            self.fetch_dl_file(self.meta_data["dl_path"]["name"], self.meta_data["dl_path"])
 
         elif "archive" in self.meta_data:
             ver = self.versions["full_version"].split(":")[-1]
@@ -707,11 +910,11 @@ class Parser():
                 (dl_url, alt_dl_url) = get_download_url(dsc_file_upstream, self.strategy)
                 if alt_dl_url:
                     try:
-                        run_shell_cmd("dget -d %s" % dl_url, self.logger)
+                        run_shell_cmd(["dget", "-d", dl_url], self.logger)
                     except:
-                        run_shell_cmd("dget -d %s" % alt_dl_url, self.logger)
+                        run_shell_cmd(["dget", "-d", alt_dl_url], self.logger)
                 else:
-                    run_shell_cmd("dget -d %s" % dl_url, self.logger)
+                    run_shell_cmd(["dget", "-d", dl_url], self.logger)
 
         elif "src_path" not in self.meta_data and "dl_hook" not in self.meta_data:
             ver = self.versions["full_version"].split(":")[-1]
@@ -723,12 +926,12 @@ class Parser():
             fullname = self.pkginfo["debname"] + "=" + self.versions["full_version"]
             supported_versions = list()
 
-            apt_pkg.init()
-            sources = apt_pkg.SourceRecords()
-            source_lookup = sources.lookup(self.pkginfo["debname"])
-            while source_lookup and self.versions["full_version"] != sources.version:
-                supported_versions.append(sources.version)
+            with APT_LOCK:
+                sources = get_apt_sources()
                 source_lookup = sources.lookup(self.pkginfo["debname"])
+                while source_lookup and self.versions["full_version"] != sources.version:
+                    supported_versions.append(sources.version)
+                    source_lookup = sources.lookup(self.pkginfo["debname"])
 
             if not source_lookup:
                 self.logger.error("No source for %s", fullname)
@@ -736,7 +939,7 @@ class Parser():
                 raise ValueError(f"No source for {fullname}")
 
             self.logger.info("Fetch %s to %s", fullname, self.pkginfo["packdir"])
-            run_shell_cmd("apt-get source -d %s" % fullname, self.logger)
+            run_shell_cmd(["apt-get", "source", "-d", fullname], self.logger)
             if self.srcrepo is not None:
                 self.upload_deb_package()
 
@@ -766,7 +969,9 @@ class Parser():
 
         sources = os.path.join(mirror, self.pkginfo["pkgname"])
         if os.path.exists(sources):
-            run_shell_cmd('cp -r %s %s' % (sources, self.basedir), self.logger)
+            # Hard link the mirror's tar balls instead of copying them
+            shutil.copytree(sources, self.pkginfo["packdir"], symlinks=True,
+                            copy_function=link_or_copy, dirs_exist_ok=True)
 
         if "dl_hook" in self.meta_data:
             self.run_dl_hook()
@@ -781,22 +986,25 @@ class Parser():
             if not os.path.exists(dsc_file):
                 self.logger.error("No dsc file \"%s\" was found in local mirror." % dsc_filename)
                 raise IOError
-            run_shell_cmd("cd %s;dpkg-source -x %s" % (self.pkginfo["packdir"], dsc_filename), self.logger)
+            run_shell_cmd(["dpkg-source", "-x", dsc_filename], self.logger, cwd=self.pkginfo["packdir"])
             self.apply_deb_patches()
         self.apply_src_patches()
 
         self.logger.info("Repackge the package %s", self.pkginfo["srcdir"])
 
         changelog = os.path.join(self.pkginfo["srcdir"], 'debian/changelog')
-        src = run_shell_cmd('dpkg-parsechangelog -l %s --show-field source' % changelog, self.logger)
-        ver = run_shell_cmd('dpkg-parsechangelog -l %s --show-field version' % changelog, self.logger)
+        # Only the top entry is needed, parse it without dpkg-parsechangelog
+        with open(changelog) as f:
+            c = debian.changelog.Changelog(f, max_blocks=1)
+        src = c.package
+        ver = str(c.version)
         ver += self.set_revision()
-        run_shell_cmd('cd %s; dch -p -D bullseye -v %s %s' % (self.pkginfo["srcdir"], ver, RELEASENOTES), self.logger)
+        run_shell_cmd(['dch', '-p', '-D', 'bullseye', '-v', ver, RELEASENOTES], self.logger, cwd=self.pkginfo["srcdir"])
         # strip epoch
         ver = ver.split(":")[-1]
 
         # Skip building(-S) and skip checking dependence(-d)
-        run_shell_cmd('cd %s; dpkg-buildpackage -nc -us -uc -S -d' % self.pkginfo["srcdir"], self.logger)
+        run_shell_cmd(['dpkg-buildpackage', '-nc', '-us', '-uc', '-S', '-d'], self.logger, cwd=self.pkginfo["srcdir"])
 
         dsc_file = src + "_" + ver + ".dsc"
         with open(os.path.join(self.pkginfo["packdir"], dsc_file)) as f:
@@ -807,9 +1015,11 @@ class Parser():
         for f in c['Files']:
             files.append(f['name'])
 
+        # The files of a dsc are plain files named relative to packdir
+        packdir = self.pkginfo["packdir"].rstrip('/') + '/'
+        output = self.output.rstrip('/') + '/'
         for f in files:
-            source = os.path.join(self.pkginfo["packdir"], f)
-            run_shell_cmd('cp -Lr %s %s' % (source, self.output), self.logger)
+            shutil.copy2(packdir + f, output + f)
 
         self.logger.removeHandler(logfile_handler)
 
@@ -829,16 +1039,18 @@ class Parser():
 
         upstream_version = BaseVersion(pkgver).upstream_version
         srcdir = "-".join([pkgname, upstream_version])
-        tarfile = srcdir + ".tar.gz"
+        tarball = srcdir + ".tar.gz"
 
         pwd = os.getcwd()
         os.chdir(packdir)
+        os.makedirs(srcdir, exist_ok=True)
         for pfile in pkgfiles:
-            run_shell_cmd('mkdir -p %s; cp %s %s' % (srcdir, pfile, srcdir), self.logger)
-        run_shell_cmd('tar czvf %s %s; rm -rf %s' % (tarfile, srcdir, srcdir), self.logger)
-        run_shell_cmd('debmake -a %s' % tarfile, self.logger)
-        run_shell_cmd('cd %s; dch -p -D bullseye -v %s %s' % (srcdir, pkgver, RELEASENOTES), self.logger)
-        run_shell_cmd('cd %s; dpkg-buildpackage -nc -us -uc -S -d' % srcdir, self.logger)
+            shutil.copy2(pfile, srcdir)
+        create_tar(tarball, srcdir, self.logger)
+        shutil.rmtree(srcdir)
+        run_shell_cmd(['debmake', '-a', tarball], self.logger)
+        run_shell_cmd(['dch', '-p', '-D', 'bullseye', '-v', pkgver, RELEASENOTES], self.logger, cwd=srcdir)
+        run_shell_cmd(['dpkg-buildpackage', '-nc', '-us', '-uc', '-S', '-d'], self.logger, cwd=srcdir)
         # strip epoch
         ver = pkgver.split(":")[-1]
 
@@ -847,9 +1059,10 @@ class Parser():
             c = debian.deb822.Dsc(f)
         os.chdir(pwd)
 
+        packdir = packdir.rstrip('/') + '/'
         files = list()
-        files.append(os.path.join(packdir, dsc_file))
+        files.append(packdir + dsc_file)
         for f in c['Files']:
-            files.append(os.path.join(packdir, f['name']))
+            files.append(packdir + f['name'])
 
         return files
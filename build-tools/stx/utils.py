@@ -22,6 +22,7 @@ import urllib.parse
 import urllib.request
 
 CENGN_BASE = os.path.join(os.environ.get('CENGNURL'), "debian")
+logger = logging.getLogger(__name__)
 
 log_levels = {
     'debug': logging.DEBUG,
@@ -31,45 +32,49 @@ log_levels = {
     'crit': logging.CRITICAL
 }
 
-def set_logger(logger, log_level='debug'):
-    logger.setLevel(log_levels[log_level])
 
-    class ColorFormatter(logging.Formatter):
-        FORMAT = ("%(asctime)s - $BOLD%(name)-s$RESET - %(levelname)s: %(message)s")
+class ColorFormatter(logging.Formatter):
+    FORMAT = ("%(asctime)s - $BOLD%(name)-s$RESET - %(levelname)s: %(message)s")
 
-        BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = list(range(8))
+    BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = list(range(8))
 
-        RESET_SEQ = "\033[0m"
-        COLOR_SEQ = "\033[1;%dm"
-        BOLD_SEQ = "\033[1m"
+    RESET_SEQ = "\033[0m"
+    COLOR_SEQ = "\033[1;%dm"
+    BOLD_SEQ = "\033[1m"
 
-        COLORS = {
-            'WARNING': YELLOW,
-            'INFO': GREEN,
-            'DEBUG': BLUE,
-            'ERROR': RED
-        }
+    COLORS = {
+        'WARNING': YELLOW,
+        'INFO': GREEN,
+        'DEBUG': BLUE,
+        'ERROR': RED
+    }
 
-        def formatter_msg(self, msg, use_color=True):
-            if use_color:
-                msg = msg.replace("$RESET", self.RESET_SEQ)
-                msg = msg.replace("$BOLD", self.BOLD_SEQ)
-            else:
-                msg = msg.replace("$RESET", "").replace("$BOLD", "")
-            return msg
-
-        def __init__(self, use_color=True):
-            msg = self.formatter_msg(self.FORMAT, use_color)
-            logging.Formatter.__init__(self, msg)
-            self.use_color = use_color
-
-        def format(self, record):
-            lname = record.levelname
-            if self.use_color and lname in self.COLORS:
-                fcolor = 30 + self.COLORS[lname]
-                lncolor = self.COLOR_SEQ % fcolor + lname + self.RESET_SEQ
-                record.levelname = lncolor
+    # Expand the format string once instead of for every formatter
+    COLOR_FORMAT = FORMAT.replace("$RESET", RESET_SEQ).replace("$BOLD", BOLD_SEQ)
+    PLAIN_FORMAT = FORMAT.replace("$RESET", "").replace("$BOLD", "")
+
+    def __init__(self, use_color=True):
+        msg = self.COLOR_FORMAT if use_color else self.PLAIN_FORMAT
+        logging.Formatter.__init__(self, msg)
+        self.use_color = use_color
+        # Colored level names are built once, format() only looks them up
+        self.levelnames = dict()
+        if use_color:
+            for lname, color in self.COLORS.items():
+                self.levelnames[lname] = self.COLOR_SEQ % (30 + color) + lname + self.RESET_SEQ
+
+    def format(self, record):
+        lname = record.levelname
+        record.levelname = self.levelnames.get(lname, lname)
+        try:
             return logging.Formatter.format(self, record)
+        finally:
+            # The record is shared with the other handlers of the logger
+            record.levelname = lname
+
+
+def set_logger(logger, log_level='debug'):
+    logger.setLevel(log_levels[log_level])
 
     # create log and console handler and set level
     fh = logging.FileHandler('/localdisk/builder.log')
@@ -93,18 +98,14 @@ def bc_safe_fetch(lst_file, entry_handler=None, entry_handler_arg=None):
     entries = []
     try:
         with open(lst_file, 'r') as flist:
-            lines = list(line for line in (p.strip() for p in flist) if line)
+            lines = [entry for entry in (p.strip() for p in flist)
+                     if entry and not entry.startswith('#')]
     except IOError as e:
         logger.error(str(e))
     except Exception as e:
         logger.error(str(e))
     else:
         for entry in lines:
-            entry = entry.strip()
-            if entry.startswith('#'):
-                continue
-            if entry == "":
-                continue
             if entry_handler:
                 if entry_handler_arg:
                     entries.extend(entry_handler(entry, entry_handler_arg))
@@ -118,15 +119,33 @@ def bc_safe_fetch(lst_file, entry_handler=None, entry_handler_arg=None):
 def limited_walk(dir, max_depth=1):
     dir = dir.rstrip(os.path.sep)
     assert os.path.isdir(dir)
-    num_sep_dir = dir.count(os.path.sep)
-    for root, dirs, files in os.walk(dir):
+    # Same top-down order and results as os.walk(), but the depth is
+    # tracked directly instead of counting separators in every path
+    stack = [(dir, 0)]
+    while stack:
+        root, depth = stack.pop()
+        dirs = []
+        files = []
+        links = set()
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                        if entry.is_symlink():
+                            links.add(entry.name)
+                    else:
+                        files.append(entry.name)
+        except OSError:
+            continue
         yield root, dirs, files
-        num_sep_root = root.count(os.path.sep)
-        if num_sep_dir + max_depth <= num_sep_root:
-            del dirs[:]
+        if depth < max_depth:
+            # The caller may have pruned dirs; never follow symlinks
+            stack.extend((os.path.join(root, d), depth + 1)
+                         for d in reversed(dirs) if d not in links)
 
 
-def run_shell_cmd(cmd, logger):
+def run_shell_cmd(cmd, logger, cwd=None):
     if type(cmd) is str:
         shell = True
     elif type(cmd) in (tuple, list):
@@ -137,7 +156,7 @@ def run_shell_cmd(cmd, logger):
     logger.info(f'[ Run - "{cmd}" ]')
     try:
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                   universal_newlines=True, shell=shell)
+                                   universal_newlines=True, shell=shell, cwd=cwd)
     except Exception as e:
         msg = f'[ Failed to execute command: "{cmd}" Exception: "{e}" ]'
         logger.error(msg)
@@ -190,14 +209,16 @@ def get_download_url(url, strategy):
         rt_url = url
     elif strategy == "cengn_first":
         try:
-            urllib.request.urlopen(cengn_url)
+            with urllib.request.urlopen(cengn_url):
+                pass
             rt_url = cengn_url
             alt_rt_url = url
         except:
             rt_url = url
     elif strategy == "upstream_first":
         try:
-            urllib.request.urlopen(url)
+            with urllib.request.urlopen(url):
+                pass
             rt_url = url
             alt_rt_url = cengn_url
         except: